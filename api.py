@@ -1,18 +1,30 @@
-import os, hashlib, hmac
+import os, hashlib, hmac, asyncio
+from functools import lru_cache
 from typing import Optional, List
 from dotenv import load_dotenv
 from fastapi import FastAPI, Depends, HTTPException, Query, Header, status
-from pydantic import BaseModel
-from sentence_transformers import SentenceTransformer
+from pydantic import BaseModel, Field
 import psycopg
-from psycopg_pool import ConnectionPool
+from psycopg.rows import dict_row
+from pgvector.psycopg import register_vector_async
+from psycopg_pool import AsyncConnectionPool
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Union, Dict, List, Optional
+from fastapi.responses import ORJSONResponse
+from typing import Union, Dict, List, Optional, Annotated
+from models import get_model
 
 load_dotenv()
 DB_URL = os.getenv("DATABASE_URL")
 API_KEY = os.getenv("API_KEY")
-MODEL_NAME = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "4096"))
+# HNSW candidate list size per query (pgvector default is 40); raised per query when 2x the vector LIMIT exceeds it
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "100"))
+# HNSW applies the pdf_id filter after the index scan, so filtered queries search a wider candidate list
+HNSW_FILTERED_EF_SEARCH = int(os.getenv("HNSW_FILTERED_EF_SEARCH", "400"))
+# pgvector >= 0.8 only: "relaxed_order" / "strict_order" keeps scanning until the filtered LIMIT is met;
+# empty disables it (older pgvector rejects the setting)
+HNSW_ITERATIVE_SCAN = os.getenv("HNSW_ITERATIVE_SCAN", "")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
 
 # --------- Security helpers ----------
 def verify_api_key(x_api_key: Optional[str] = Header(default=None, alias="X-API-Key")):
@@ -24,18 +36,41 @@ def verify_api_key(x_api_key: Optional[str] = Header(default=None, alias="X-API-
     return True
 
 # --------- App & middlewares ----------
-app = FastAPI(title="PDF Search API", version="1.0")
+app = FastAPI(title="PDF Search API", version="1.0", default_response_class=ORJSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[],  # set allowed origins in prod, e.g. ["https://your-frontend.com"]
     allow_credentials=False,
-    allow_methods=["GET"],
+    allow_methods=["GET", "POST"],
     allow_headers=["X-API-Key", "Content-Type"],
 )
 
 # --------- DB & model ----------
-pool = ConnectionPool(DB_URL, min_size=1, max_size=10, kwargs={"autocommit": True})
-model = SentenceTransformer(MODEL_NAME)
+async def _configure_conn(conn):
+    # runs once per new connection: register pgvector types (numpy arrays are sent as vectors,
+    # no per-query type lookup) and set the session's default ef_search
+    await register_vector_async(conn)
+    await conn.execute(f"SET hnsw.ef_search = {HNSW_EF_SEARCH:d}")
+
+# prepare_threshold=0: every statement is prepared server-side on first use (skips re-parse/re-plan)
+# async pool so DB roundtrips don't block the event loop; opened (and filled) in the startup hook.
+# min_size == max_size keeps every connection warm instead of ramping up under load.
+pool = AsyncConnectionPool(
+    DB_URL,
+    min_size=DB_POOL_SIZE,
+    max_size=DB_POOL_SIZE,
+    kwargs={"autocommit": True, "prepare_threshold": 0},
+    configure=_configure_conn,
+    open=False,
+)
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _encode(q: str):
+    # query traffic is heavily skewed, so repeat queries skip the encoder entirely;
+    # the cached array is shared between callers, hence read-only
+    emb = get_model().encode([q], normalize_embeddings=True)[0]
+    emb.setflags(write=False)
+    return emb
 
 # --------- Schemas ----------
 class SearchHit(BaseModel):
@@ -52,14 +87,112 @@ class SearchResponse(BaseModel):
     pdf_id: Optional[str] = None
     hits: List[SearchHit]
 
+class SearchBatchRequest(BaseModel):
+    queries: List[Annotated[str, Field(min_length=1, max_length=500)]] = Field(..., min_length=1, max_length=32)
+    pdf_id: Optional[str] = None
+    k: int = Field(default=20, ge=1, le=100)
+
+class SearchBatchResponse(BaseModel):
+    results: List[SearchResponse]
+
 # --------- Search ----------
-def hybrid_search(q: str, pdf_id: Optional[str], k: int = 20, alpha: float = 0.5):
+# vector candidates fed into the fusion, independent of k
+HYBRID_VEC_LIMIT = 50
+
+# lex/vec only carry (chunk_id, score); the wide columns are fetched once by primary key at the end.
+# Built once per doc_filter variant so the SQL text is stable and psycopg's prepared-statement cache hits.
+_HYBRID_SQL = """
+    WITH
+      lex AS (
+        SELECT
+          c.id AS chunk_id,
+          ts_rank_cd(c.tsv, plainto_tsquery('english', %s)) AS score
+        FROM chunks c
+        WHERE {doc_filter}c.tsv @@ plainto_tsquery('english', %s)
+        ORDER BY score DESC
+        LIMIT 50
+      ),
+      vec AS (
+        SELECT
+          c.id AS chunk_id,
+          1 - (c.embedding_h <=> %s::halfvec) AS score
+        FROM chunks c
+        WHERE {doc_filter}TRUE
+        -- <=> (cosine) matches the HNSW index opclass; <-> would bypass the index
+        ORDER BY c.embedding_h <=> %s::halfvec
+        LIMIT {vec_limit}
+      ),
+      fused AS (
+        SELECT
+          chunk_id,
+          COALESCE(l.score, 0) * %s + COALESCE(v.score, 0) * %s AS fused_score
+        FROM lex l
+        FULL OUTER JOIN vec v USING (chunk_id)
+        ORDER BY fused_score DESC
+        LIMIT %s
+      )
+    SELECT c.id AS chunk_id, c.document_id, c.page_number, c.type, c.text, c.bbox, f.fused_score
+    FROM fused f
+    JOIN chunks c ON c.id = f.chunk_id
+    ORDER BY f.fused_score DESC;
+    """
+HYBRID_SQL_DOC = _HYBRID_SQL.format(doc_filter="c.document_id = %s AND ", vec_limit=HYBRID_VEC_LIMIT)
+HYBRID_SQL_ALL = _HYBRID_SQL.format(doc_filter="", vec_limit=HYBRID_VEC_LIMIT)
+
+# Vector-only KNN for many queries in one statement: one LATERAL index scan per query embedding.
+_BATCH_SQL = """
+    WITH q AS (
+      SELECT t.qid, t.emb::halfvec(384) AS emb
+      FROM unnest(%s::vector[]) WITH ORDINALITY AS t(emb, qid)
+    )
+    SELECT q.qid, h.chunk_id, h.document_id, h.page_number, h.type, h.text, h.bbox, h.score
+    FROM q
+    CROSS JOIN LATERAL (
+      SELECT
+        c.id AS chunk_id, c.document_id, c.page_number, c.type, c.text, c.bbox,
+        1 - (c.embedding_h <=> q.emb) AS score
+      FROM chunks c
+      WHERE {doc_filter}TRUE
+      ORDER BY c.embedding_h <=> q.emb
+      LIMIT %s
+    ) h
+    ORDER BY q.qid, h.score DESC;
+    """
+BATCH_SQL_DOC = _BATCH_SQL.format(doc_filter="c.document_id = %s AND ")
+BATCH_SQL_ALL = _BATCH_SQL.format(doc_filter="")
+
+async def _fetch_all(sql: str, params: list, vec_limit: int, filtered: bool = False) -> list:
+    # vec_limit is the LIMIT of the statement's HNSW scan; ef_search must comfortably exceed it.
+    # filtered (pdf_id) scans drop non-matching neighbours after the index scan, so they get a
+    # larger ef_search and, if enabled, iterative scanning
+    settings = {}
+    ef_search = max(2 * vec_limit, HNSW_FILTERED_EF_SEARCH if filtered else 0)
+    if ef_search > HNSW_EF_SEARCH:
+        settings["hnsw.ef_search"] = str(ef_search)
+    if filtered and HNSW_ITERATIVE_SCAN:
+        settings["hnsw.iterative_scan"] = HNSW_ITERATIVE_SCAN
+
+    async with pool.connection() as conn, conn.cursor(row_factory=dict_row) as cur:
+        if settings:
+            # override the session defaults for this query only; set_config(..., true) is SET LOCAL, but parameterizable
+            async with conn.transaction():
+                await cur.execute(
+                    "SELECT " + ", ".join(["set_config(%s, %s, true)"] * len(settings)),
+                    [v for item in settings.items() for v in item],
+                )
+                await cur.execute(sql, params, prepare=True)
+        else:
+            await cur.execute(sql, params, prepare=True)
+        return await cur.fetchall()
+
+async def hybrid_search(q: str, pdf_id: Optional[str], k: int = 20, alpha: float = 0.5):
     q_text = q.strip()
     if not q_text:
         return []
 
-    # Compute embedding once
-    q_emb = model.encode([q_text], normalize_embeddings=True)[0].tolist()
+    # Compute embedding once (cached; the default model is uncased, so case/spacing don't change it)
+    # encoding is CPU-bound, so run it off the event loop
+    q_emb = await asyncio.to_thread(_encode, " ".join(q_text.lower().split()))
 
     # Build params in correct order depending on pdf_id
     if pdf_id:
@@ -67,81 +200,51 @@ def hybrid_search(q: str, pdf_id: Optional[str], k: int = 20, alpha: float = 0.5
             q_text,      # 1) ts_rank_cd(... %s)
             pdf_id,      # 2) WHERE c.document_id = %s AND ...
             q_text,      # 3) ... @@ plainto_tsquery('english', %s)
-            q_emb,       # 4) SELECT 1 - (embedding <=> %s::vector)
+            q_emb,       # 4) SELECT 1 - (embedding_h <=> %s::halfvec)
             pdf_id,      # 5) WHERE c.document_id = %s AND TRUE
-            q_emb,       # 6) ORDER BY embedding <-> %s::vector
+            q_emb,       # 6) ORDER BY embedding_h <=> %s::halfvec
             alpha,       # 7) fused weight (lex)
             1.0 - alpha, # 8) fused weight (vec)
             k,           # 9) LIMIT
         ]
-        doc_filter = "c.document_id = %s AND "
+        sql = HYBRID_SQL_DOC
     else:
         params = [
             q_text,      # 1) ts_rank_cd(... %s)
             q_text,      # 2) ... @@ plainto_tsquery('english', %s)
-            q_emb,       # 3) SELECT 1 - (embedding <=> %s::vector)
-            q_emb,       # 4) ORDER BY embedding <-> %s::vector
+            q_emb,       # 3) SELECT 1 - (embedding_h <=> %s::halfvec)
+            q_emb,       # 4) ORDER BY embedding_h <=> %s::halfvec
             alpha,       # 5) fused weight (lex)
             1.0 - alpha, # 6) fused weight (vec)
             k,           # 7) LIMIT
         ]
-        doc_filter = ""
+        sql = HYBRID_SQL_ALL
 
-    sql = f"""
-    WITH
-      lex AS (
-        SELECT
-          c.id as chunk_id, c.document_id, c.page_number, c.type, c.text, c.bbox,
-          ts_rank_cd(c.tsv, plainto_tsquery('english', %s)) AS score
-        FROM chunks c
-        WHERE {doc_filter} c.tsv @@ plainto_tsquery('english', %s)
-        ORDER BY score DESC
-        LIMIT 50
-      ),
-      vec AS (
-        SELECT
-          c.id as chunk_id, c.document_id, c.page_number, c.type, c.text, c.bbox,
-          1 - (c.embedding <=> %s::vector) AS score
-        FROM chunks c
-        WHERE {doc_filter} TRUE
-        ORDER BY c.embedding <-> %s::vector
-        LIMIT 50
-      ),
-      allhits AS (
-        SELECT *,'lex' AS kind FROM lex
-        UNION ALL
-        SELECT *,'vec' AS kind FROM vec
-      ),
-      fused AS (
-        SELECT
-          chunk_id, document_id, page_number, type, text, bbox,
-          MAX(CASE WHEN kind='lex' THEN score ELSE 0 END) * %s
-          + MAX(CASE WHEN kind='vec' THEN score ELSE 0 END) * %s
-          AS fused_score
-        FROM allhits
-        GROUP BY chunk_id, document_id, page_number, type, text, bbox
-      )
-    SELECT chunk_id, document_id, page_number, type, text, bbox, fused_score
-    FROM fused
-    ORDER BY fused_score DESC
-    LIMIT %s;
-    """
+    rows = await _fetch_all(sql, params, HYBRID_VEC_LIMIT, filtered=bool(pdf_id))
+    # rows come straight from our own schema, so skip per-field validation
+    return [SearchHit.model_construct(score=float(r.pop("fused_score")), **r) for r in rows]
 
-    with pool.connection() as conn, conn.cursor() as cur:
-        cur.execute(sql, params)
-        rows = cur.fetchall()
-        return [
-            dict(
-                chunk_id=r[0],
-                document_id=r[1],
-                page_number=r[2],
-                type=r[3],
-                text=r[4],
-                bbox=r[5],
-                score=float(r[6]),
-            )
-            for r in rows
-        ]
+async def batch_vector_search(queries: List[str], pdf_id: Optional[str], k: int = 20) -> List[List[SearchHit]]:
+    q_texts = [" ".join(q.lower().split()) for q in queries]
+    live = [i for i, q in enumerate(q_texts) if q]
+    hits: List[List[SearchHit]] = [[] for _ in queries]
+    if not live:
+        return hits
+
+    # one batched encode for all queries instead of one call each
+    embs = await asyncio.to_thread(
+        get_model().encode, [q_texts[i] for i in live], batch_size=len(live), normalize_embeddings=True
+    )
+
+    if pdf_id:
+        params, sql = [list(embs), pdf_id, k], BATCH_SQL_DOC
+    else:
+        params, sql = [list(embs), k], BATCH_SQL_ALL
+
+    for r in await _fetch_all(sql, params, k, filtered=bool(pdf_id)):
+        # qid is the 1-based position in the embedding array
+        hits[live[r.pop("qid") - 1]].append(SearchHit.model_construct(score=float(r.pop("score")), **r))
+    return hits
 
 # --------- Endpoints ----------
 @app.get("/healthz")
@@ -149,20 +252,43 @@ def healthz():
     return {"ok": True}
 
 @app.get("/search", response_model=SearchResponse)
-def search(
+async def search(
     q: str = Query(..., min_length=1, max_length=500),
     pdf_id: Optional[str] = Query(default=None),
     k: int = Query(default=20, ge=1, le=100),
     alpha: float = Query(default=0.55, ge=0.0, le=1.0),
     _: bool = Depends(verify_api_key),
 ):
-    hits = hybrid_search(q, pdf_id, k=k, alpha=alpha)
-    return {"query": q, "pdf_id": pdf_id, "hits": hits}
+    hits = await hybrid_search(q, pdf_id, k=k, alpha=alpha)
+    # returned as a Response so FastAPI doesn't re-validate the hits against response_model
+    # (which is still used for the OpenAPI schema)
+    resp = SearchResponse.model_construct(query=q, pdf_id=pdf_id, hits=hits)
+    return ORJSONResponse(resp.model_dump())
+
+@app.post("/search_batch", response_model=SearchBatchResponse)
+async def search_batch(body: SearchBatchRequest, _: bool = Depends(verify_api_key)):
+    # vector-only (no lexical fusion); all queries share one encode call and one SQL roundtrip
+    hits = await batch_vector_search(body.queries, body.pdf_id, k=body.k)
+    resp = SearchBatchResponse.model_construct(results=[
+        SearchResponse.model_construct(query=q, pdf_id=body.pdf_id, hits=h) for q, h in zip(body.queries, hits)
+    ])
+    return ORJSONResponse(resp.model_dump())
+
+@app.get("/debug/cache")
+def debug_cache(_: bool = Depends(verify_api_key)):
+    return _encode.cache_info()._asdict()
+
+# --------- Startup & graceful shutdown ----------
+@app.on_event("startup")
+async def _startup():
+    # load + warm the encoder before serving so the first /search doesn't pay for it
+    await asyncio.to_thread(get_model)
+    # wait until the pool holds min_size connections, so no request opens one cold
+    await pool.open(wait=True)
 
-# --------- Graceful shutdown ----------
 @app.on_event("shutdown")
-def _shutdown():
+async def _shutdown():
     try:
-        pool.close()
+        await pool.close()
     except Exception:
         pass
@@ -2,29 +2,58 @@ import argparse, json, os, re, math
 from typing import List, Dict
 from datetime import datetime
 import numpy as np
-from sentence_transformers import SentenceTransformer
+from numba import njit, prange
+import polars as pl
 import psycopg
+from psycopg.types.json import Jsonb
+from pgvector.psycopg import HalfVector, register_vector
 from psycopg_pool import ConnectionPool
 from dotenv import load_dotenv
+from models import get_model, USE_CUDA
 
 load_dotenv()
 DB_URL = os.getenv("DATABASE_URL")
-MODEL_NAME = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+DEFAULT_BATCH_SIZE = 256 if USE_CUDA else 64
 
 # ---------------- Utilities ----------------
-def normalize_ws(s: str) -> str:
-    # collapse whitespace, keep paragraphs
-    s = re.sub(r'\r\n?', '\n', s)
-    s = re.sub(r'[ \t]+', ' ', s)
-    s = re.sub(r'\n{3,}', '\n\n', s)
-    return s.strip()
+# compiled once; used for every piece longer than max_chars
+_RE_SENT = re.compile(r'(?<=[.!?])\s+')
+
+def normalize_ws_batch(texts: List[str]) -> List[str]:
+    # collapse whitespace, keep paragraphs: CR/CRLF -> LF, runs of spaces/tabs -> one space,
+    # 3+ newlines -> one blank line, then strip; done over all pieces at once with polars' (Rust) string kernels
+    return (
+        pl.Series("text", texts, dtype=pl.String)
+        .str.replace_all(r"\r\n?", "\n")
+        .str.replace_all(r"[ \t]+", " ")
+        .str.replace_all(r"\n{3,}", "\n\n")
+        .str.strip_chars()
+        .to_list()
+    )
 
 def flatten_table(cells: List[List[str]]) -> str:
-    # join headers + rows into a linearized string for search
-    rows = []
-    for row in cells:
-        rows.append(" | ".join([normalize_ws(str(c)) for c in row]))
-    return "\n".join(rows)
+    # join headers + rows into a linearized string for search; cells are stripped here (cheap),
+    # the rest of the whitespace is normalized with the other pieces
+    return "\n".join(" | ".join(str(c).strip() for c in row) for row in cells)
+
+def _as_float(v) -> float | None:
+    # NaN/Infinity aren't valid JSON, so Postgres would reject the jsonb; treat them as missing
+    try:
+        f = float(v)
+    except (TypeError, ValueError):
+        return None
+    return f if math.isfinite(f) else None
+
+def normalize_bbox(bbox) -> Dict | List:
+    # store bbox as plain floats (dict or list) so the API can serialize it without coercion;
+    # never fails the document: non-numeric dict values are dropped, and a list that isn't
+    # all-numeric (nulls, nested points) becomes {} since dropping entries would shift positions
+    if isinstance(bbox, dict):
+        return {str(k): f for k, f in ((k, _as_float(v)) for k, v in bbox.items()) if f is not None}
+    if isinstance(bbox, (list, tuple)):
+        out = [_as_float(v) for v in bbox]
+        return out if out and None not in out else {}
+    return {}
 
 def chunk_long_text(text: str, max_chars: int = 1800) -> List[str]:
     # safe chunking on sentence boundaries
@@ -32,7 +61,7 @@ def chunk_long_text(text: str, max_chars: int = 1800) -> List[str]:
         return [text]
     parts, buf = [], []
     size = 0
-    sentences = re.split(r'(?<=[.!?])\s+', text)
+    sentences = _RE_SENT.split(text)
     for sent in sentences:
         if size + len(sent) + 1 > max_chars and buf:
             parts.append(" ".join(buf).strip())
@@ -43,11 +72,44 @@ def chunk_long_text(text: str, max_chars: int = 1800) -> List[str]:
         parts.append(" ".join(buf).strip())
     return parts
 
+@njit(parallel=True, fastmath=True, cache=True)
+def l2_normalize_rows(x, order, out):
+    # row L2 normalization fused with the un-sort: out[order[i]] = x[i] / ||x[i]||,
+    # a single read of x and a single write of out, rows in parallel
+    for i in prange(x.shape[0]):
+        s = 0.0
+        for j in range(x.shape[1]):
+            s += x[i, j] * x[i, j]
+        inv = 1.0 / math.sqrt(max(s, 1e-12))
+        r = order[i]
+        for j in range(x.shape[1]):
+            out[r, j] = x[i, j] * inv
+
+def embed_texts(model, texts: List[str], batch_size: int = 64) -> np.ndarray:
+    # "smart batching": encode in length order so each mini-batch pads to similar lengths,
+    # then scatter back so row i still matches texts[i]
+    order = np.array(sorted(range(len(texts)), key=lambda i: len(texts[i])), dtype=np.int64)
+    embs_sorted = model.encode(
+        [texts[i] for i in order],
+        batch_size=batch_size,
+        convert_to_numpy=True,
+        show_progress_bar=True,
+    )
+    # fp16 (GPU) output is upcast so the norm is computed in fp32; storage casts to halfvec later anyway
+    embs_sorted = np.asarray(embs_sorted, dtype=np.float32)
+    # L2-normalize the whole batch (rather than per row inside encode) while restoring the original order
+    embs = np.empty_like(embs_sorted)
+    l2_normalize_rows(embs_sorted, order, embs)
+    return embs
+
 # ---------------- DB ----------------
-pool = ConnectionPool(DB_URL, min_size=1, max_size=5, kwargs={"autocommit": True})
+INSERT_BATCH_SIZE = 500
+
+# register_vector lets numpy arrays / HalfVector be sent as pgvector values (also inside COPY)
+pool = ConnectionPool(DB_URL, min_size=1, max_size=5, kwargs={"autocommit": True}, configure=register_vector)
 
-def upsert_document(doc_id: str, title: str, num_pages: int, s3_key: str | None = None):
-    with pool.connection() as conn, conn.cursor() as cur:
+def upsert_document(conn: psycopg.Connection, doc_id: str, title: str, num_pages: int, s3_key: str | None = None):
+    with conn.cursor() as cur:
         cur.execute(
             """
             INSERT INTO documents(id, title, num_pages, s3_key)
@@ -58,18 +120,22 @@ def upsert_document(doc_id: str, title: str, num_pages: int, s3_key: str | None
             (doc_id, title, num_pages, s3_key),
         )
 
-def insert_chunk(doc_id: str, type_: str, page: int, bbox: Dict, text: str, emb: np.ndarray):
-    with pool.connection() as conn, conn.cursor() as cur:
-        cur.execute(
-            """
-            INSERT INTO chunks(document_id, type, page_number, bbox, text, tokens, embedding)
-            VALUES (%s, %s, %s, %s::jsonb, %s, %s, %s)
-            """,
-            (doc_id, type_, page, json.dumps(bbox), text, len(text.split()), emb.tolist()),
-        )
+def insert_chunks(conn: psycopg.Connection, doc_id: str, pieces: List[tuple], embs: np.ndarray):
+    # one binary COPY per batch instead of one INSERT (and roundtrip) per chunk; binary format sends
+    # each halfvec as raw fp16 bytes instead of 384 formatted floats
+    with conn.cursor() as cur:
+        with cur.copy(
+            "COPY chunks (document_id, type, page_number, bbox, text, tokens, embedding_h) FROM STDIN (FORMAT BINARY)"
+        ) as cp:
+            cp.set_types(["text", "text", "int4", "jsonb", "text", "int4", "halfvec"])
+            # embeddings are stored as halfvec: half the bytes per row on disk and in distance scans
+            # (HalfVector does the fp32 -> fp16 conversion per row)
+            for (type_, page, bbox, text), emb in zip(pieces, embs):
+                cp.write_row((doc_id, type_, page, Jsonb(bbox), text, len(text.split()), HalfVector(emb)))
 
 # ---------------- ETL ----------------
-def run_etl(parsed_json_path: str, document_id: str | None = None, title: str | None = None, s3_key: str | None = None):
+def run_etl(parsed_json_path: str, document_id: str | None = None, title: str | None = None, s3_key: str | None = None,
+            batch_size: int | None = None):
     with open(parsed_json_path, "r", encoding="utf-8") as f:
         data = json.load(f)
 
@@ -79,19 +145,11 @@ def run_etl(parsed_json_path: str, document_id: str | None = None, title: str |
     title = title or data.get("title", doc_id)
     num_pages = int(data.get("num_pages", 0))
 
-    print(f"[ETL] Loading model: {MODEL_NAME}")
-    model = SentenceTransformer(MODEL_NAME)
-
-    print(f"[ETL] Upserting document {doc_id}")
-    upsert_document(doc_id, title, num_pages, s3_key)
+    # collect raw (type, page, bbox, text) first so text cleanup and embeddings can run batched
+    raw = []
 
     def add_text_piece(type_, page, bbox, raw_text):
-        raw_text = normalize_ws(raw_text)
-        if not raw_text:
-            return
-        for part in chunk_long_text(raw_text):
-            emb = model.encode([part], normalize_embeddings=True)[0]
-            insert_chunk(doc_id, type_, page, bbox or {}, part, emb)
+        raw.append((type_, page, normalize_bbox(bbox), raw_text))
 
     # Paragraphs
     for p in data.get("paragraphs", []):
@@ -110,6 +168,32 @@ def run_etl(parsed_json_path: str, document_id: str | None = None, title: str |
         if im.get("ocr_text"):
             add_text_piece("image_ocr", int(im.get("page", 0)), im.get("bbox", {}), im.get("ocr_text"))
 
+    # normalize every piece in one vectorized pass; only the (few) long ones need the Python sentence splitter
+    # (polars' regex engine has no lookbehind, so chunk_long_text stays as is)
+    pieces = []
+    for (type_, page, bbox, _), text in zip(raw, normalize_ws_batch([r[3] for r in raw])):
+        if not text:
+            continue
+        for part in chunk_long_text(text):
+            pieces.append((type_, page, bbox, part))
+
+    embs = None
+    if pieces:
+        batch_size = batch_size or DEFAULT_BATCH_SIZE
+        print(f"[ETL] Embedding {len(pieces)} chunks (batch_size={batch_size})")
+        embs = embed_texts(get_model(), [p[3] for p in pieces], batch_size=batch_size)
+    else:
+        print("[ETL] No text found, nothing to embed.")
+
+    # all DB writes for the document go through one connection and one transaction
+    with pool.connection() as conn, conn.transaction():
+        print(f"[ETL] Upserting document {doc_id}")
+        upsert_document(conn, doc_id, title, num_pages, s3_key)
+        if pieces:
+            print(f"[ETL] Inserting {len(pieces)} chunks")
+            for i in range(0, len(pieces), INSERT_BATCH_SIZE):
+                insert_chunks(conn, doc_id, pieces[i:i + INSERT_BATCH_SIZE], embs[i:i + INSERT_BATCH_SIZE])
+
     print("[ETL] Done.")
 
 if __name__ == "__main__":
@@ -118,5 +202,6 @@ if __name__ == "__main__":
     ap.add_argument("--document-id", required=False)
     ap.add_argument("--title", required=False)
     ap.add_argument("--s3-key", required=False, help="S3 key of the original PDF (optional)")
+    ap.add_argument("--batch-size", type=int, default=None, help="Embedding batch size (default: 256 on GPU, 64 on CPU)")
     args = ap.parse_args()
-    run_etl(args.json, args.document_id, args.title, args.s3_key)
+    run_etl(args.json, args.document_id, args.title, args.s3_key, batch_size=args.batch_size)
@@ -0,0 +1,15 @@
+-- Move chunk embeddings from VECTOR(384) (fp32) to HALFVEC(384) (fp16).
+-- For databases created from the original schema.sql; fresh installs already have embedding_h.
+-- Requires pgvector >= 0.7.
+
+ALTER TABLE chunks ADD COLUMN IF NOT EXISTS embedding_h HALFVEC(384);
+
+UPDATE chunks SET embedding_h = embedding::halfvec(384)
+WHERE embedding_h IS NULL AND embedding IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_chunks_embedding_h ON chunks USING hnsw (embedding_h halfvec_cosine_ops)
+  WITH (m = 16, ef_construction = 64);
+
+-- Once search results on embedding_h are verified, drop the full-precision column:
+-- DROP INDEX IF EXISTS idx_chunks_embedding;
+-- ALTER TABLE chunks DROP COLUMN embedding;
@@ -0,0 +1,28 @@
+import os
+from functools import lru_cache
+import torch
+from sentence_transformers import SentenceTransformer
+from dotenv import load_dotenv
+
+load_dotenv()
+MODEL_NAME = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+# "onnx" runs the encoder through onnxruntime (much faster on CPU); "torch" keeps the PyTorch backend
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "onnx")
+
+# on a GPU, run the PyTorch model on CUDA in fp16 regardless of EMBEDDING_BACKEND
+USE_CUDA = torch.cuda.is_available()
+if USE_CUDA:
+    EMBEDDING_BACKEND = "torch"
+
+# ---------------- Model ----------------
+@lru_cache(maxsize=1)
+def get_model() -> SentenceTransformer:
+    # one shared instance per process (API + ETL), warmed up so the first real encode is fast
+    if EMBEDDING_BACKEND == "torch" and not USE_CUDA:
+        torch.set_num_threads(os.cpu_count() or 1)
+    print(f"[model] Loading {MODEL_NAME} (backend={EMBEDDING_BACKEND}, cuda={USE_CUDA})")
+    m = SentenceTransformer(MODEL_NAME, backend=EMBEDDING_BACKEND, device="cuda" if USE_CUDA else None)
+    if USE_CUDA:
+        m.half()
+    m.encode(["warmup"])
+    return m
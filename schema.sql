@@ -8,7 +8,7 @@ CREATE TABLE IF NOT EXISTS documents (
   created_at   TIMESTAMPTZ DEFAULT now()
 );
 
--- 384 dims for all-MiniLM-L6-v2
+-- 384 dims for all-MiniLM-L6-v2, stored as half precision (pgvector >= 0.7)
 CREATE TABLE IF NOT EXISTS chunks (
   id           BIGSERIAL PRIMARY KEY,
   document_id  TEXT REFERENCES documents(id) ON DELETE CASCADE,
@@ -17,11 +17,14 @@ CREATE TABLE IF NOT EXISTS chunks (
   bbox         JSONB,
   text         TEXT NOT NULL,
   tokens       INT,
-  embedding    VECTOR(384),
+  embedding_h  HALFVEC(384),
   tsv          tsvector GENERATED ALWAYS AS (to_tsvector('english', coalesce(text,''))) STORED
 );
 
+-- Leading document_id column also serves the API's "c.document_id = %s" filter.
 CREATE INDEX IF NOT EXISTS idx_chunks_doc ON chunks(document_id, page_number);
+-- tsv is a STORED generated column, so lexical search is a GIN index scan, not per-row to_tsvector().
 CREATE INDEX IF NOT EXISTS idx_chunks_tsv ON chunks USING GIN (tsv);
--- Vector index (IVFFlat). You must ANALYZE on big datasets; adjust lists.
-CREATE INDEX IF NOT EXISTS idx_chunks_embedding ON chunks USING ivfflat (embedding vector_cosine_ops) WITH (lists = 100);
+-- Vector index (HNSW over halfvec, cosine distance).
+CREATE INDEX IF NOT EXISTS idx_chunks_embedding_h ON chunks USING hnsw (embedding_h halfvec_cosine_ops)
+  WITH (m = 16, ef_construction = 64);